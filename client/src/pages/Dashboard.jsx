@@ -1,13 +1,17 @@
 import { useEffect, useState } from "react";
-import { getAdvisory } from "../services/api";
+import { getAdvisory, getAQI } from "../services/api";
 import { auth, db } from "../services/firebase";
-import { doc, getDoc } from "firebase/firestore";
+import { doc, getDoc, collection, query, orderBy, limit, onSnapshot } from "firebase/firestore";
 import { useNavigate } from "react-router-dom";
 import ReactMarkdown from "react-markdown";
 
 // Icons
 import { Wind, Activity, MapPin, AlertTriangle, CheckCircle, Loader2, Footprints, Home, Dumbbell } from "lucide-react";
 
+const DISMISSED_ALERT_KEY = "respi_guard_dismissed_alert";
+// Same as the server's AQI_CACHE_TTL: a cell reading never changes sooner
+const AQI_REFRESH_MS = 15 * 60 * 1000;
+
 // --- HELPERS ---
 
 // Official Indian CPCB Color Scale
@@ -42,8 +46,46 @@ export default function Dashboard() {
      name: "Locating...", 
      coords: "GPS Initializing" 
   });
+  const [aqiAlert, setAqiAlert] = useState(null);
+  const [coords, setCoords] = useState(null);
   const navigate = useNavigate();
 
+  // Proactive AQI alerts: the server writes users/{uid}/alerts, Firestore pushes them here
+  useEffect(() => {
+    if (!auth.currentUser) return;
+    const uid = auth.currentUser.uid;
+
+    const latestAlert = query(
+      collection(db, "users", uid, "alerts"),
+      orderBy("created_at", "desc"),
+      limit(1)
+    );
+    return onSnapshot(
+      latestAlert,
+      (snap) => {
+        const latest = snap.docs[0] && { id: snap.docs[0].id, ...snap.docs[0].data() };
+        const dismissed = localStorage.getItem(`${DISMISSED_ALERT_KEY}_${uid}`);
+        if (latest && !latest.read && latest.id !== dismissed) setAqiAlert(latest);
+      },
+      (error) => console.error("Alert listener failed", error)
+    );
+  }, []);
+
+  // Keep the AQI ring fresh with the cheap, cacheable /aqi endpoint (no LLM call)
+  useEffect(() => {
+    if (!coords) return;
+
+    const timer = setInterval(async () => {
+      try {
+        const res = await getAQI(coords.lat, coords.lon);
+        setData((prev) => prev && { ...prev, aqi: res.aqi });
+      } catch (error) {
+        console.error("AQI refresh failed", error);
+      }
+    }, AQI_REFRESH_MS);
+    return () => clearInterval(timer);
+  }, [coords]);
+
   useEffect(() => {
     const init = async () => {
       if (!auth.currentUser) return navigate("/login");
@@ -59,6 +101,7 @@ export default function Dashboard() {
         async (pos) => {
           const lat = pos.coords.latitude;
           const lon = pos.coords.longitude;
+          setCoords({ lat, lon });
 
           // 1. Set Coordinates immediately
           setLocationInfo(prev => ({ 
@@ -122,6 +165,28 @@ export default function Dashboard() {
           </div>
         </div>
 
+        {/* === AQI ALERT BANNER === */}
+        {aqiAlert && (
+          <div className="flex items-start gap-3 rounded-2xl bg-red-50/80 backdrop-blur-md border border-red-200 shadow-sm p-4 animate-fade-in-up">
+            <AlertTriangle className="text-red-600 shrink-0 mt-0.5" size={22} />
+            <div className="flex-1">
+              <p className="font-bold text-red-700">
+                Air quality alert: {aqiAlert.from_category} → {aqiAlert.to_category}
+              </p>
+              <p className="text-sm text-slate-700">{aqiAlert.message}</p>
+            </div>
+            <button
+              onClick={() => {
+                localStorage.setItem(`${DISMISSED_ALERT_KEY}_${auth.currentUser.uid}`, aqiAlert.id);
+                setAqiAlert(null);
+              }}
+              className="text-sm font-semibold text-slate-500 hover:text-slate-700"
+            >
+              Dismiss
+            </button>
+          </div>
+        )}
+
         {/* === TOP SECTION: SPEEDOMETER & METRICS === */}
         <div className="grid lg:grid-cols-2 gap-8">
           
@@ -4,9 +4,31 @@ import axios from "axios";
 // const BASE_URL = "http://localhost:5000/api";
 const BASE_URL = import.meta.env.VITE_BACKEND_URL;
 
+// Last advisory + its ETag, so a refresh with unchanged AQI/profile gets a tiny 304
+const ADVISORY_CACHE_KEY = "respi_guard_advisory";
+
 export const getAdvisory = async (payload) => {
+  const cacheKey = `${ADVISORY_CACHE_KEY}_${payload.uid}`;
+  const cached = JSON.parse(localStorage.getItem(cacheKey) || "null");
+
   // 2. ERROR WAS HERE: You used ${API_BASE} instead of ${BASE_URL}
-  const res = await axios.post(`${BASE_URL}/get-advisory`, payload);
+  const res = await axios.post(`${BASE_URL}/get-advisory`, payload, {
+    headers: cached ? { "If-None-Match": cached.etag } : {},
+    validateStatus: (status) => (status >= 200 && status < 300) || status === 304,
+  });
+
+  if (res.status === 304 && cached) {
+    return cached.data;
+  }
+
+  if (res.headers.etag) {
+    localStorage.setItem(cacheKey, JSON.stringify({ etag: res.headers.etag, data: res.data }));
+  }
+  return res.data;
+};
+
+export const getAQI = async (lat, lon) => {
+  const res = await axios.get(`${BASE_URL}/aqi`, { params: { lat, lon } });
   return res.data;
 };
 
@@ -23,4 +45,4 @@ export const saveUserProfile = async (payload) => {
 export const sendSOSAlert = async (payload) => {
   const res = await axios.post(`${BASE_URL}/sos-alert`, payload);
   return res.data;
-};
\ No newline at end of file
+};
@@ -0,0 +1,295 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows dev machines: no host-wide limit, per-process only
+    fcntl = None
+
+##Admission control for everything that calls Gemini##
+# SOS voice, chat and advisories all share one Gemini quota and the same
+# worker threads. Every LLM call goes through llm_gate.slot(...) so that:
+#   1. only LLM_MAX_CONCURRENCY calls run at once per worker process, and
+#      only LLM_HOST_CONCURRENCY across all gunicorn workers on the host.
+#      SOS skips the per-worker cap and has LLM_HOST_SOS_SLOTS extra host
+#      slots of its own, so an advisory burst can never hold every slot.
+#   2. each user has a token bucket (SOS is never rate limited and never
+#      rejected for queue depth, but only waits LLM_SOS_QUEUE_TIMEOUT for a slot)
+#   3. waiting calls are served by priority: SOS > chat > advisory > prewarm
+#   4. too-deep queues reject early instead of piling up (backpressure)
+# Priority ordering is per worker; across workers the host slots are first
+# come, first served. Rate limits are also per worker (a user's requests are
+# spread over workers, so the effective limit is at most workers x rate).
+
+
+# ================== PRIORITIES ==================
+class Priority:
+    SOS = 0
+    CHAT = 1
+    ADVISORY = 2
+    PREWARM = 3
+
+PRIORITY_NAMES = {
+    Priority.SOS: "sos",
+    Priority.CHAT: "chat",
+    Priority.ADVISORY: "advisory",
+    Priority.PREWARM: "prewarm",
+}
+
+
+class AdmissionRejected(Exception):
+    """Raised when a call is refused (rate limited, queue full or timed out)."""
+
+    def __init__(self, reason, retry_after=1):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# ================== PER-USER TOKEN BUCKET ==================
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate            # tokens refilled per second
+        self.burst = burst          # bucket size
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Takes one token. Returns 0 on success, else seconds until the next token."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+# ================== HOST-WIDE SLOTS ==================
+class HostSlots:
+    """
+    Slots shared by every worker on the host: one fcntl byte-range lock per slot.
+    Bytes [0, slots) are for any call, [slots, slots + sos_slots) for SOS only.
+    """
+
+    def __init__(self, path, slots, sos_slots=1):
+        self.slots = slots
+        self.sos_slots = sos_slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._held = set()          # fcntl locks are per process, so track our own threads
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline, sos=False):
+        """Returns a slot index, or None if none freed up before `deadline` (monotonic)."""
+        # SOS tries its reserved slots first, leaving the shared ones to others
+        if sos:
+            candidates = list(range(self.slots, self.slots + self.sos_slots)) + list(range(self.slots))
+        else:
+            candidates = range(self.slots)
+        while True:
+            with self._lock:
+                for i in candidates:
+                    if i in self._held:
+                        continue
+                    try:
+                        fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, i)
+                    except OSError:
+                        continue
+                    self._held.add(i)
+                    return i
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.02)
+
+    def release(self, i):
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, i)
+            self._held.discard(i)
+
+
+def _open_host_slots(path, slots, sos_slots):
+    if fcntl is None:
+        return None
+    try:
+        return HostSlots(path, slots, sos_slots)
+    except OSError as e:
+        print(f"⚠️ Host-wide LLM limit disabled: {e}")
+        return None
+
+
+# ================== THE GATE ==================
+class AdmissionController:
+    def __init__(self, max_concurrent, max_queue_depth, rate, burst, queue_timeout, sos_timeout,
+                 host_slots=None):
+        self.max_concurrent = max_concurrent
+        self.max_queue_depth = max_queue_depth
+        self.rate = rate
+        self.burst = burst
+        self.queue_timeout = queue_timeout
+        self.sos_timeout = sos_timeout
+        self.host_slots = host_slots
+        self._thread = threading.local()    # host slot held by the current thread
+
+        self._cond = threading.Condition()
+        self._waiting = []              # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._in_flight = 0
+
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self._buckets_pruned = time.monotonic()
+
+        self._stats = {
+            p: {"admitted": 0, "rejected": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for p in PRIORITY_NAMES
+        }
+
+    # ---------- rate limit ----------
+    def _check_rate(self, priority, uid):
+        # Emergencies are never throttled
+        if priority == Priority.SOS or not uid:
+            return
+        with self._buckets_lock:
+            self._prune_buckets()
+            bucket = self._buckets.get(uid)
+            if bucket is None:
+                bucket = self._buckets[uid] = TokenBucket(self.rate, self.burst)
+            wait = bucket.take()
+        if wait:
+            self._reject(priority, "rate_limited", retry_after=max(1, round(wait)))
+
+    def _prune_buckets(self):
+        # A bucket idle long enough to be full again is the same as a new one
+        now = time.monotonic()
+        if now - self._buckets_pruned < 60:
+            return
+        self._buckets_pruned = now
+        refill = self.burst / self.rate
+        for uid in [u for u, b in self._buckets.items() if now - b.updated >= refill]:
+            del self._buckets[uid]
+
+    def _reject(self, priority, reason, retry_after=1):
+        with self._cond:
+            self._stats[priority]["rejected"] += 1
+        raise AdmissionRejected(reason, retry_after)
+
+    def _depth_ahead(self, priority):
+        # Only calls of the same or higher priority can delay this one
+        return sum(1 for p, _ in self._waiting if p <= priority)
+
+    # ---------- acquire / release ----------
+    def acquire(self, priority, uid=None):
+        self._check_rate(priority, uid)
+
+        start = time.monotonic()
+        with self._cond:
+            if priority != Priority.SOS and self._depth_ahead(priority) >= self.max_queue_depth:
+                self._stats[priority]["rejected"] += 1
+                raise AdmissionRejected("queue_full")
+
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            # SOS gets a short, bounded wait; the caller falls back to static instructions
+            deadline = start + (self.sos_timeout if priority == Priority.SOS else self.queue_timeout)
+
+            # SOS is not held back by the per-worker cap (only by the host slots)
+            while (priority != Priority.SOS and self._in_flight >= self.max_concurrent) \
+                    or self._waiting[0] != ticket:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._stats[priority]["rejected"] += 1
+                    self._cond.notify_all()
+                    raise AdmissionRejected("queue_timeout")
+                self._cond.wait(remaining)
+
+            heapq.heappop(self._waiting)
+            self._in_flight += 1
+            self._cond.notify_all()
+
+        # Then one of the host-wide slots shared with the other workers
+        self._thread.host_slot = None
+        if self.host_slots is not None:
+            host_slot = self.host_slots.acquire(deadline, sos=priority == Priority.SOS)
+            if host_slot is None:
+                self._release_local()
+                self._reject(priority, "queue_timeout")
+            self._thread.host_slot = host_slot
+
+        waited = time.monotonic() - start
+        with self._cond:
+            stats = self._stats[priority]
+            stats["admitted"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+        return waited
+
+    def _release_local(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def release(self):
+        host_slot = getattr(self._thread, "host_slot", None)
+        if host_slot is not None:
+            self.host_slots.release(host_slot)
+            self._thread.host_slot = None
+        self._release_local()
+
+    @contextmanager
+    def slot(self, priority, uid=None):
+        """Holds one LLM slot for the block. Yields the seconds spent queueing."""
+        waited = self.acquire(priority, uid)
+        try:
+            yield waited
+        finally:
+            self.release()
+
+    # ---------- metrics ----------
+    def snapshot(self):
+        with self._cond:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for p, _ in self._waiting:
+                depth[PRIORITY_NAMES[p]] += 1
+
+            per_priority = {}
+            for p, s in self._stats.items():
+                per_priority[PRIORITY_NAMES[p]] = {
+                    "admitted": s["admitted"],
+                    "rejected": s["rejected"],
+                    "queue_depth": depth[PRIORITY_NAMES[p]],
+                    "avg_wait_ms": round(1000 * s["wait_total"] / s["admitted"], 1) if s["admitted"] else 0.0,
+                    "max_wait_ms": round(1000 * s["wait_max"], 1),
+                }
+
+            return {
+                "pid": os.getpid(),
+                "in_flight": self._in_flight,
+                "max_concurrent": self.max_concurrent,
+                "host_concurrency": self.host_slots.slots if self.host_slots else None,
+                "host_sos_slots": self.host_slots.sos_slots if self.host_slots else None,
+                "tracked_users": len(self._buckets),
+                "max_queue_depth": self.max_queue_depth,
+                "priorities": per_priority,
+            }
+
+
+# Single gate shared by app.py and features.py
+llm_gate = AdmissionController(
+    max_concurrent=int(os.getenv("LLM_MAX_CONCURRENCY", "4")),
+    max_queue_depth=int(os.getenv("LLM_MAX_QUEUE_DEPTH", "16")),
+    rate=float(os.getenv("LLM_USER_RATE_PER_MIN", "6")) / 60.0,
+    burst=int(os.getenv("LLM_USER_BURST", "3")),
+    queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "20")),
+    sos_timeout=float(os.getenv("LLM_SOS_QUEUE_TIMEOUT", "5")),
+    host_slots=_open_host_slots(
+        os.getenv("LLM_HOST_LOCK", "/tmp/respi-guard-llm.lock"),
+        int(os.getenv("LLM_HOST_CONCURRENCY", os.getenv("LLM_MAX_CONCURRENCY", "4"))),
+        int(os.getenv("LLM_HOST_SOS_SLOTS", "1")),
+    ),
+)
@@ -1,10 +1,12 @@
 import os
 import json
 import requests
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 from dotenv import load_dotenv
 import datetime
+import time
+import hashlib
 
 import firebase_admin
 from firebase_admin import credentials, firestore
@@ -15,15 +17,21 @@ from langchain_google_genai import (
 )
 from langchain_pinecone import PineconeVectorStore
 
-from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.output_parsers import StrOutputParser
 # from langchain.memory import ConversationBufferWindowMemory # OLD import
 # from langchain_core.memory import ConversationBufferWindowMemory # <-- short Memory for conversation history, last 4
 
 load_dotenv(override=True)
+from admission import llm_gate, Priority, AdmissionRejected  # reads LLM_* limits from .env
+import profiler
+from profiler import stage, note
+from shared_cache import TieredCache, cache_stats  # one cache for all gunicorn workers
+from retrieval import build_route_retrievers
+from ingest import build_documents
+from prompt_cache import prompt_metrics
+from chains import ADVISORY_PREFIX, ADVISORY_SUFFIX, CHAT_PREFIX, CHAT_SUFFIX, build_rag_chain
+
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["ETag", "Cache-Control", "Retry-After"])
 
 # ================== ENV ==================
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
@@ -78,7 +86,14 @@ vectorstore = PineconeVectorStore(
     index_name=PINECONE_INDEX_NAME,
     embedding=embeddings,
 )
-retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
+
+# Route-aware hybrid retrieval (BM25 + vector), cached across workers.
+# Same query -> same guideline sections until the corpus is re-ingested
+RETRIEVAL_CACHE_TTL = int(os.getenv("RETRIEVAL_CACHE_TTL", "86400"))
+guideline_docs = build_documents()
+retrievers = build_route_retrievers(
+    vectorstore, guideline_docs, TieredCache("retrieval"), RETRIEVAL_CACHE_TTL
+)
 
 llm = ChatGoogleGenerativeAI(
     model="gemini-2.5-flash",
@@ -124,14 +139,19 @@ def get_indian_aqi_category(aqi):
 
 
 # ================== AQI HELPER FUNCTION ==================
-def get_live_aqi(lat, lon):
-    try:
-        lat_f = float(lat)
-        lon_f = float(lon)
-    except ValueError:
-        print("❌ [AQI ERROR]: Invalid coordinates format")
-        return None
-    
+# Readings are cached per grid cell (~5km at AQI_CELL_DEG=0.05), so every user
+# in the same neighbourhood shares one OpenWeather call per AQI_CACHE_TTL.
+AQI_CELL_DEG = float(os.getenv("AQI_CELL_DEG", "0.05"))
+AQI_CACHE_TTL = int(os.getenv("AQI_CACHE_TTL", "900"))   # OpenWeather air data refreshes ~hourly
+aqi_cell_cache = TieredCache("aqi")
+
+
+def aqi_cell(lat_f, lon_f):
+    return f"{round(lat_f / AQI_CELL_DEG)}:{round(lon_f / AQI_CELL_DEG)}"
+
+
+def fetch_openweather_aqi(lat_f, lon_f):
+    """Returns (aqi_data, observed_at) from OpenWeather, or None if it is unreachable."""
     url = f"http://api.openweathermap.org/data/2.5/air_pollution?lat={lat_f}&lon={lon_f}&appid={OPENWEATHER_API_KEY}"
     
     try:
@@ -140,12 +160,12 @@ def get_live_aqi(lat, lon):
 
         if response.status_code != 200 or "list" not in data:
             print(f"❌ OpenWeather Error: {data.get('message', 'Unknown Error')}")
-            # Mock fallback for hackathon safety
-            return {"aqi_index": 5, "pm2_5": 75.4, "indian_aqi": 151} 
+            return None
 
         # Extract Raw Data
         aqi_index = data["list"][0]["main"]["aqi"] # 1-5 Scale (Internal use only)
         pm2_5 = data["list"][0]["components"]["pm2_5"] # Raw Concentration
+        observed_at = data["list"][0].get("dt", int(time.time())) # When OpenWeather measured it
 
         # Calculate Indian AQI
         indian_aqi = calculate_indian_aqi(pm2_5)
@@ -154,13 +174,78 @@ def get_live_aqi(lat, lon):
             "aqi_index": aqi_index, 
             "pm2_5": pm2_5,
             "indian_aqi": indian_aqi  # <--- Sends Indian Standard
-        }
+        }, observed_at
 
     except Exception as e:
         print(f"❌ [AQI HELPER CRASH]: {e}")
         return None
 
 
+def get_cell_reading(lat, lon):
+    """
+    Cached AQI reading for the cell containing (lat, lon):
+    {"cell", "aqi", "observed_at", "expires_at"}. None for bad coordinates.
+    """
+    try:
+        lat_f = float(lat)
+        lon_f = float(lon)
+    except (TypeError, ValueError):
+        print("❌ [AQI ERROR]: Invalid coordinates format")
+        return None
+
+    cell = aqi_cell(lat_f, lon_f)
+    now = time.time()
+    entry = aqi_cell_cache.get(cell)  # shared with the other workers
+    if entry and entry["expires_at"] > now:
+        return entry
+
+    # Query the cell centre so every user in the cell gets the same reading
+    result = fetch_openweather_aqi(
+        round(lat_f / AQI_CELL_DEG) * AQI_CELL_DEG,
+        round(lon_f / AQI_CELL_DEG) * AQI_CELL_DEG,
+    )
+    if result is None:
+        # Mock fallback for hackathon safety
+        # (not cached, expires quickly so we retry OpenWeather soon)
+        return {
+            "cell": cell,
+            "aqi": {"aqi_index": 5, "pm2_5": 75.4, "indian_aqi": 151},
+            "observed_at": int(now),
+            "expires_at": now + 60,
+            "mock": True,
+        }
+
+    aqi_data, observed_at = result
+    entry = {
+        "cell": cell,
+        "aqi": aqi_data,
+        "observed_at": observed_at,
+        "expires_at": now + AQI_CACHE_TTL,
+    }
+    aqi_cell_cache.set(cell, entry, AQI_CACHE_TTL)
+    return entry
+
+
+# ================== HTTP CACHING HELPERS ==================
+def make_etag(*parts):
+    return hashlib.sha256("|".join(str(p) for p in parts).encode()).hexdigest()[:32]
+
+
+def cached_response(response, etag, max_age, private=True):
+    """Adds ETag + Cache-Control (max-age = time left on the AQI reading)."""
+    response.set_etag(etag)
+    response.cache_control.max_age = max(0, int(max_age))
+    if private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    return response
+
+
+def not_modified(etag, max_age, private=True):
+    return cached_response(Response(status=304), etag, max_age, private)
+
+
 # ================== DB HELPERS ==================
 def get_user_profile_from_db(uid):
     """Fetches Condition, Meds, and Age from Firestore"""
@@ -186,139 +271,11 @@ def get_user_profile_from_db(uid):
 
 
 
-# ================== PROMPT ==================
-#Prompt API1
-ADVISORY_PROMPT = PromptTemplate.from_template(
-    """
-You are Respi-Guard. Analyze the Indian Air Quality (NAQI) and user health.
-Return your response in strictly VALID JSON format.
-
-Structure:
-{{
-  "advisory_text": "Medical advice citing sources, but adding practical mitigation (e.g., N95 masks).",
-  "activities": {{
-     "outdoor_exercise": {{"status": "Avoid", "color": "red"}}, 
-     "light_walk": {{"status": "Caution (Mask Required)", "color": "yellow"}}, 
-     "indoor_ventilation": {{"status": "Safe", "color": "green"}}
-  }}
-}}
-
-CONTEXT:
-{context}
-
-USER PROFILE:
-{user_profile}
-
-LIVE AIR QUALITY:
-{aqi_data}
-(Note: 'indian_aqi' follows CPCB standards. >300 is Very Poor.)
-
-INSTRUCTIONS:
-1. **Prioritize Safety but be Pragmatic:** - For "outdoor_exercise": If AQI > 200 (Poor), mark as RED ("Avoid"). Heavy breathing is dangerous.
-   - For "light_walk" (Commute): If AQI is High (200-400), do NOT mark as Red. Mark as YELLOW ("Caution") and strictly advise wearing an N95 Mask. Only mark Red if AQI > 400 (Severe).
-   - For "indoor_ventilation": If AQI > 150, mark as RED ("Close Windows"). Use Air Purifier if possible.
-
-2. ALWAYS mention "N95 Mask" if the status is Yellow or Red.
-3. Cite sources (GINA/WHO).
-
-RESPONSE:
-"""
-)
-
-######################################################################################################################
-
-
-
-
-
-
-#Prompt API2
-CHAT_PROMPT = PromptTemplate.from_template(
-    """
-SYSTEM ROLE:
-You are **Respi-Guard**, a specialized Pulmonology AI Assistant. Your sole purpose is to provide respiratory health advice, interpret air quality data, and offer guidance based on clinical protocols.
-
-⛔ STRICT GUARDRAILS (DO NOT IGNORE):
-1. **Scope Restriction**: If the user asks about coding, politics, movies, general trivia, or anything unrelated to health/weather, politely refuse. Say: "I can only assist with respiratory health and air quality monitoring."
-2. **No Hallucinations**: If the answer is not found in the 'CONTEXT' or 'AQI DATA', admit you don't know. Do not invent medical advice.
-3. **Emergency Protocol**: If the user indicates severe distress (e.g., "I can't breathe," "Chest pain"), ignore standard advice and tell them to press the **SOS Button** or call emergency services immediately.
-
----
-
-📥 INPUT DATA:
-1. **CLINICAL CONTEXT** (Guidelines & RAG): 
-{context}
-
-2. **USER PROFILE** (The Patient): 
-{user_profile}
-
-3. **REAL-TIME ENVIRONMENT** (Live AQI): 
-{aqi_data}
-
-4. **CONVERSATION HISTORY**: 
-{history}
-
----
-
-USER QUESTION: 
-{question}
-
----
-
-📝 INSTRUCTIONS FOR RESPONSE:
-1. **Personalize**: Always tailor the answer to the User's specific condition and medications listed in 'USER PROFILE'.
-2. **Check the Air**: If the user asks about going outside, exercising, or opening windows, you MUST cross-reference the 'REAL-TIME ENVIRONMENT'.
-   - *Example*: "Since your AQI is {aqi_data} and you have Asthma, stay indoors."
-3. **Cite Sources**: When providing medical facts from the 'CLINICAL CONTEXT', explicitly cite the source (e.g., [Source: GINA Guidelines]).
-4. **Tone**: Professional, empathetic, and concise. Do not use robotic fillers like "As an AI...".
-5. **Format**: Use Markdown (bolding for warnings, bullet points for steps). Do NOT use JSON.
-
-YOUR RESPONSE:
-"""
-)
-
-    
-
-## 1st retrieve ->  format -> send to LLM! ### 
-
-# ================== HELPER FUNCTION FOR CONTEXT ==================
-def format_docs(docs):
-    # This combines the JSON chunks and adds the source tag for the LLM
-    formatted = []
-    for doc in docs:
-        source = doc.metadata.get("source", "Unknown Source")
-        formatted.append(f"CONTENT: {doc.page_content}\nSOURCE: {source}\n---")
-    return "\n".join(formatted)
-
-
-
-# ================== RAG CHAIN updated to latest, ig, ig ==================
-def build_advisory_chain(user_profile, aqi_data):
-    return (
-        {
-            "context": retriever | format_docs,
-            "question": RunnablePassthrough(), # Questions are hardcoded in the route
-            "user_profile": lambda _: user_profile,
-            "aqi_data": lambda _: aqi_data,
-        }
-        | ADVISORY_PROMPT
-        | llm
-        | StrOutputParser()
-    )
-
-def build_chat_chain(user_profile, aqi_data, history):
-    return (
-        {
-            "context": retriever | format_docs,
-            "question": RunnablePassthrough(),
-            "user_profile": lambda _: user_profile,
-            "aqi_data": lambda _: aqi_data,
-            "history": lambda _: history, # <--- Passes history to prompt
-        }
-        | CHAT_PROMPT
-        | llm
-        | StrOutputParser()
-    )
+# ================== RAG CHAINS (built once, reused by every request) ==================
+#   ADVISORY_CHAIN.invoke({"question": ..., "user_profile": ..., "aqi_data": ...})
+#   CHAT_CHAIN.invoke({"question": ..., "user_profile": ..., "aqi_data": ..., "history": ...})
+ADVISORY_CHAIN = build_rag_chain("advisory", ADVISORY_PREFIX, ADVISORY_SUFFIX, retrievers["advisory"], llm)
+CHAT_CHAIN = build_rag_chain("chat", CHAT_PREFIX, CHAT_SUFFIX, retrievers["chat"], llm)
 
 
 
@@ -341,6 +298,20 @@ def save_turn(session_id, user_msg, ai_msg):                            #
 #########################################################################
 
 
+# ====== ADVISORY CACHE (shared by all workers) ======
+# "etag:<etag>" -> advisory for that AQI reading + profile
+# "uid:<uid>"   -> last good advisory, served when the LLM queue is saturated
+ADVISORY_CACHE_TTL = int(os.getenv("ADVISORY_CACHE_TTL", "3600"))
+LAST_ADVISORY_TTL = 24 * 3600
+advisory_cache = TieredCache("advisory")
+
+
+def too_busy(reason):
+    """429 with Retry-After so the client backs off instead of retrying instantly."""
+    response = jsonify({"error": "Respi-Guard is busy, please retry shortly.", "reason": reason.reason})
+    response.headers["Retry-After"] = str(reason.retry_after)
+    return response, 429
+
 
 
 
@@ -366,26 +337,49 @@ def get_advisory():
 
     # 2. FETCH USER PROFILE FROM DB (Backend Logic)
     # We use the helper function to get the real medical data
-    user_profile = get_user_profile_from_db(uid)
+    with stage("profile_db"):
+        user_profile = get_user_profile_from_db(uid)
     print(f"👤 Generating Advisory for: {user_profile}")
 
-    # 3. FETCH LIVE AQI
-    aqi_data = get_live_aqi(lat, lon)
-    if not aqi_data:
+    # 3. FETCH LIVE AQI (cached per cell)
+    with stage("aqi_fetch"):
+        reading = get_cell_reading(lat, lon)
+    if not reading:
         return jsonify({"error": "Failed to fetch AQI data"}), 500
+    aqi_data = reading["aqi"]
+
+    # 3b. HTTP CACHING: the advice only changes when the reading or the profile does
+    profile_sig = hashlib.sha256(str(user_profile).encode()).hexdigest()[:16]
+    etag = make_etag("advisory", reading["cell"], reading["observed_at"], profile_sig)
+    max_age = reading["expires_at"] - time.time()
+
+    if etag in request.if_none_match:
+        note("http_cache", "304")
+        return not_modified(etag, max_age)
 
     # 4. SAVE AQI CONTEXT TO FIRESTORE (Crucial for Chatbot)
     # This saves the 'latest_aqi' so the /ask-doctor endpoint can read it later
     if db and uid:
         try:
-            db.collection('users').document(uid).update({
-                "latest_aqi": aqi_data,
-                "latest_aqi_timestamp": datetime.datetime.now()
-            })
+            with stage("aqi_save"):
+                db.collection('users').document(uid).update({
+                    "latest_aqi": aqi_data,
+                    "latest_aqi_timestamp": datetime.datetime.now(),
+                    "latest_location": {"lat": float(lat), "lon": float(lon)}  # for AQI push alerts
+                })
             print("💾 AQI Context Saved to Firestore for Chatbot use")
         except Exception as e:
             print(f"⚠️ Failed to save AQI context: {e}")
 
+    # Same reading + same profile already answered (e.g. another device): skip the LLM
+    known_advisory = advisory_cache.get(f"etag:{etag}")
+    if known_advisory is not None:
+        note("http_cache", "server_hit")
+        return cached_response(jsonify({
+            "aqi": aqi_data,
+            "advisory": known_advisory
+        }), etag, max_age)
+
     # Determine Category for context
     category = get_indian_aqi_category(aqi_data['indian_aqi'])
 
@@ -398,12 +392,33 @@ def get_advisory():
     )
 
     # USE THE ADVISORY CHAIN (Uses the JSON Prompt)
-    rag_chain = build_advisory_chain(
-        user_profile=str(user_profile),
-        aqi_data=str(aqi_data),
-    )
+    chain_input = {
+        "question": query,
+        "user_profile": str(user_profile),
+        "aqi_data": str(aqi_data),
+    }
+
+    note("query_chars", len(query))
+    note("profile_chars", len(str(user_profile)))
 
-    raw_response = rag_chain.invoke(query)
+    try:
+        with llm_gate.slot(Priority.ADVISORY, uid) as waited:
+            note("llm_queue_ms", round(1000 * waited, 1))
+            with stage("rag_chain"):
+                raw_response = ADVISORY_CHAIN.invoke(chain_input)
+    except AdmissionRejected as busy:
+        # Degrade to the last advisory we generated for this user (fresh AQI though)
+        cached = advisory_cache.get(f"uid:{uid}") if uid else None
+        if not cached:
+            return too_busy(busy)
+        print(f"⏳ LLM busy ({busy.reason}), serving cached advisory")
+        response = jsonify({
+            "aqi": aqi_data,
+            "advisory": cached,
+            "degraded": True
+        })
+        response.cache_control.no_store = True
+        return response
 
     # === JSON PARSING LOGIC (KEPT EXACTLY AS YOU REQUESTED) ===
     try:
@@ -417,11 +432,44 @@ def get_advisory():
             "advisory_text": raw_response,
             "activities": {} 
         }
-
-    return jsonify({
+        # Not cached and no ETag: the next request gets a fresh try at the LLM
+        response = jsonify({
+            "aqi": aqi_data,
+            "advisory": advisory_json
+        })
+        response.cache_control.no_store = True
+        return response
+
+    if uid:
+        advisory_cache.set(f"uid:{uid}", advisory_json, LAST_ADVISORY_TTL)
+    advisory_cache.set(f"etag:{etag}", advisory_json, ADVISORY_CACHE_TTL)
+
+    return cached_response(jsonify({
         "aqi": aqi_data,
         "advisory": advisory_json 
-    })
+    }), etag, max_age)
+
+
+# =========================
+# AQI ONLY (cheap, CDN-cacheable)
+# =========================
+@app.route("/api/aqi", methods=["GET"])
+def get_aqi():
+    reading = get_cell_reading(request.args.get("lat"), request.args.get("lon"))
+    if not reading:
+        return jsonify({"error": "lat and lon query parameters are required"}), 400
+
+    etag = make_etag("aqi", reading["cell"], reading["observed_at"])
+    max_age = reading["expires_at"] - time.time()
+    if etag in request.if_none_match:
+        return not_modified(etag, max_age, private=False)
+
+    aqi_data = reading["aqi"]
+    return cached_response(jsonify({
+        "aqi": aqi_data,
+        "category": get_indian_aqi_category(aqi_data["indian_aqi"]),
+        "observed_at": reading["observed_at"],
+    }), etag, max_age, private=False)
 
 
 
@@ -437,7 +485,8 @@ def ask_doctor():
     question = data.get("query")
     
     # 2. FETCH USER PROFILE FROM DB (Backend Logic)
-    user_profile = get_user_profile_from_db(uid)
+    with stage("profile_db"):
+        user_profile = get_user_profile_from_db(uid)
 
     # 3. FETCH SAVED AQI CONTEXT FROM DB
     # The doctor needs to know the "context" of the environment
@@ -445,7 +494,8 @@ def ask_doctor():
     
     if db and uid:
         try:
-            doc = db.collection('users').document(uid).get()
+            with stage("aqi_context_db"):
+                doc = db.collection('users').document(uid).get()
             if doc.exists:
                 user_data = doc.to_dict()
                 # We retrieve the specific AQI data saved by the /get-advisory route
@@ -463,13 +513,23 @@ def ask_doctor():
 
     # 5. RUN RAG CHAT
     # This chain now has access to: Medical Docs (RAG) + User Profile + Live AQI + Chat History
-    rag_chain = build_chat_chain(
-        user_profile=user_profile,
-        aqi_data=aqi_context,
-        history=history_text
-    )
+    chain_input = {
+        "question": question,
+        "user_profile": user_profile,
+        "aqi_data": aqi_context,
+        "history": history_text,
+    }
+
+    note("query_chars", len(question or ""))
+    note("history_chars", len(history_text))
 
-    response = rag_chain.invoke(question)
+    try:
+        with llm_gate.slot(Priority.CHAT, uid) as waited:
+            note("llm_queue_ms", round(1000 * waited, 1))
+            with stage("rag_chain"):
+                response = CHAT_CHAIN.invoke(chain_input)
+    except AdmissionRejected as busy:
+        return too_busy(busy)
 
     # 6. SAVE CONVERSATION
     save_turn(uid, question, response)
@@ -480,8 +540,30 @@ def ask_doctor():
 
 
 
+# =========================
+# LLM QUEUE METRICS
+# =========================
+@app.route("/api/llm-stats", methods=["GET"])
+def llm_stats():
+    return jsonify(llm_gate.snapshot())
+
+
+@app.route("/api/cache-stats", methods=["GET"])
+def get_cache_stats():
+    return jsonify(cache_stats())
+
+
+@app.route("/api/prompt-cache-stats", methods=["GET"])
+def get_prompt_cache_stats():
+    return jsonify(prompt_metrics.snapshot())
+
+
 import features
-features.register_routes(app, retriever, llm, db)
+features.register_routes(app, retrievers["sos"], llm, db, guideline_docs)
+profiler.register_routes(app)
+
+import aqi_alerts
+aqi_alerts.register_routes(app, db, get_cell_reading, aqi_cell, get_indian_aqi_category)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,216 @@
+import os
+import time
+import datetime
+import threading
+
+from flask import jsonify
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+##Proactive AQI alerts##
+# Instead of every user polling, we watch CELLS (the same grid used for the
+# AQI cache). One background loop per host:
+#   1. reads each watched cell once (cached reading, so ~1 OpenWeather call/cell)
+#   2. maps it to the CPCB category
+#   3. if the category got worse and crossed AQI_ALERT_MIN_CATEGORY, looks up
+#      the users in that cell (inverted index cell -> uids) and writes one
+#      alert per user to Firestore in batches
+#   4. the dashboard listens on users/{uid}/alerts, so Firestore pushes it
+# Work per cycle grows with the number of cells, not the number of users.
+# The index is rebuilt from Firestore (users/*.latest_location, written by
+# /api/get-advisory) inside the leader worker only, so alerts need Firestore:
+# in mock DB mode the detector does not run.
+
+AQI_ALERTS_ENABLED = os.getenv("AQI_ALERTS_ENABLED", "1") == "1"
+AQI_ALERT_INTERVAL = int(os.getenv("AQI_ALERT_INTERVAL", "600"))
+AQI_ALERT_MIN_CATEGORY = os.getenv("AQI_ALERT_MIN_CATEGORY", "Very Poor")
+AQI_ALERT_LOCK = os.getenv("AQI_ALERT_LOCK", "/tmp/respi-guard-alerts.lock")
+ALERT_BATCH_SIZE = 400  # Firestore allows 500 writes per batch
+
+CATEGORY_ORDER = ["Good", "Satisfactory", "Moderate", "Poor", "Very Poor", "Severe"]
+
+
+# ================== INVERTED INDEX ==================
+class CellIndex:
+    """cell -> set of uids, built from each user's last known coordinates."""
+
+    def __init__(self):
+        self.cell_users = {}
+        self.user_cell = {}
+        self.cell_coords = {}      # any coordinate inside the cell, used to read it
+        self._lock = threading.Lock()
+
+    def subscribe(self, uid, cell, lat, lon):
+        with self._lock:
+            old = self.user_cell.get(uid)
+            if old == cell:
+                return
+            if old is not None:
+                users = self.cell_users.get(old, set())
+                users.discard(uid)
+                if not users:
+                    self.cell_users.pop(old, None)
+                    self.cell_coords.pop(old, None)
+            self.user_cell[uid] = cell
+            self.cell_users.setdefault(cell, set()).add(uid)
+            self.cell_coords.setdefault(cell, (lat, lon))
+
+    def cells(self):
+        with self._lock:
+            return list(self.cell_coords.items())
+
+    def users_in(self, cell):
+        with self._lock:
+            return sorted(self.cell_users.get(cell, ()))
+
+
+# ================== TRANSITION DETECTOR ==================
+class TransitionDetector:
+    def __init__(self, index, read_cell, categorize, notify):
+        self.index = index
+        self.read_cell = read_cell
+        self.categorize = categorize
+        self.notify = notify
+        self.is_leader = False      # only the leader worker has an index and stats
+        self.last_category = {}
+        self.stats = {"cycles": 0, "cells_checked": 0, "transitions": 0, "alerts_sent": 0}
+
+    def check_once(self):
+        min_rank = CATEGORY_ORDER.index(AQI_ALERT_MIN_CATEGORY)
+        for cell, (lat, lon) in self.index.cells():
+            reading = self.read_cell(lat, lon)
+            if not reading or reading.get("mock"):
+                continue
+            self.stats["cells_checked"] += 1
+
+            category = self.categorize(reading["aqi"]["indian_aqi"])
+            previous = self.last_category.get(cell)
+            self.last_category[cell] = category
+
+            # First look at a cell only sets the baseline
+            if previous is None:
+                continue
+            rank = CATEGORY_ORDER.index(category)
+            if rank > CATEGORY_ORDER.index(previous) and rank >= min_rank:
+                self.stats["transitions"] += 1
+                self.fan_out(cell, previous, category, reading)
+        self.stats["cycles"] += 1
+
+    def fan_out(self, cell, previous, category, reading):
+        uids = self.index.users_in(cell)
+        alert = {
+            "type": "aqi_transition",
+            "from_category": previous,
+            "to_category": category,
+            "indian_aqi": reading["aqi"]["indian_aqi"],
+            "pm2_5": reading["aqi"]["pm2_5"],
+            "observed_at": reading["observed_at"],
+            "message": (
+                f"Air quality near you is now {category} (NAQI {reading['aqi']['indian_aqi']}). "
+                f"Keep your reliever inhaler close and wear an N95 mask outdoors."
+            ),
+        }
+        print(f"📢 Cell {cell}: {previous} -> {category}, alerting {len(uids)} users")
+        for i in range(0, len(uids), ALERT_BATCH_SIZE):
+            batch = uids[i:i + ALERT_BATCH_SIZE]
+            self.notify(batch, alert)
+            self.stats["alerts_sent"] += len(batch)
+
+
+def firestore_notifier(db):
+    """Writes the alert to users/{uid}/alerts, one Firestore batch per chunk of users."""
+    def notify(uids, alert):
+        if not db:
+            print(f"⚠️ Mock DB: would alert {uids}")
+            return
+        try:
+            batch = db.batch()
+            created_at = datetime.datetime.now()
+            for uid in uids:
+                ref = db.collection('users').document(uid).collection('alerts').document()
+                batch.set(ref, {**alert, "created_at": created_at, "read": False})
+            batch.commit()
+        except Exception as e:
+            print(f"❌ Alert batch failed: {e}")
+    return notify
+
+
+# ================== BACKGROUND LOOP ==================
+def _try_become_leader():
+    """Only one gunicorn worker per host runs the detector (non-blocking file lock)."""
+    if fcntl is None:
+        return True
+    try:
+        fd = os.open(AQI_ALERT_LOCK, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as e:
+        print(f"⚠️ Cannot open AQI alert lock {AQI_ALERT_LOCK}: {e}")
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True     # fd stays open for the life of the process = we keep the lock
+    except OSError:
+        os.close(fd)
+        return False
+
+
+def _load_subscriptions(db, index, cell_of, since):
+    """Adds users whose location changed since `since` (all users when since is None)."""
+    if not db:
+        return
+    try:
+        users = db.collection('users')
+        if since is not None:
+            users = users.where("latest_aqi_timestamp", ">", since)
+        for doc in users.select(["latest_location"]).stream():
+            location = (doc.to_dict() or {}).get("latest_location")
+            if location:
+                lat, lon = float(location["lat"]), float(location["lon"])
+                index.subscribe(doc.id, cell_of(lat, lon), lat, lon)
+    except Exception as e:
+        print(f"⚠️ Could not load alert subscriptions: {e}")
+
+
+def _run(detector, db, cell_of):
+    synced_at = None
+    while True:
+        if not detector.is_leader:
+            detector.is_leader = _try_become_leader()
+            if detector.is_leader:
+                print("📡 AQI alert detector running in this worker")
+        if detector.is_leader:
+            started = datetime.datetime.now()
+            _load_subscriptions(db, detector.index, cell_of, synced_at)
+            synced_at = started
+            try:
+                detector.check_once()
+            except Exception as e:
+                print(f"❌ AQI alert cycle failed: {e}")
+        time.sleep(AQI_ALERT_INTERVAL)
+
+
+cell_index = CellIndex()
+detector = None
+
+
+def register_routes(app, db, read_cell, cell_of, categorize):
+    global detector
+    detector = TransitionDetector(cell_index, read_cell, categorize, firestore_notifier(db))
+
+    if AQI_ALERTS_ENABLED and not db:
+        print("⚠️ Mock DB: AQI alerts disabled (subscriptions come from Firestore)")
+    elif AQI_ALERTS_ENABLED:
+        threading.Thread(target=_run, args=(detector, db, cell_of), name="aqi-alerts", daemon=True).start()
+
+    @app.route("/api/alert-stats", methods=["GET"])
+    def alert_stats():
+        # Only the leader worker has data; ask again to reach another worker
+        return jsonify({
+            "pid": os.getpid(),
+            "is_leader": detector.is_leader,
+            "cells": len(cell_index.cell_coords),
+            "users": len(cell_index.user_cell),
+            **detector.stats,
+        })
@@ -0,0 +1,81 @@
+import os
+import time
+import tracemalloc
+
+# Local stand-ins for the Gemini context cache / shared memory tier
+os.environ.setdefault("PROMPT_CACHE_BACKEND", "local")
+os.environ.setdefault("SHARED_CACHE_ENABLED", "0")
+
+from langchain_core.documents import Document
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.runnables import RunnableLambda
+
+from chains import CHAT_PREFIX, CHAT_SUFFIX, build_rag_chain
+
+##Micro-benchmark: per-request chain building vs. one prebuilt chain##
+# Builds the real chat chain from chains.py (prompt + cached_prefix_llm +
+# parser) around a fake retriever + fake LLM, so only LangChain overhead is
+# measured.
+# Run:  python bench_chains.py
+
+N = 2000
+
+DOCS = [Document(page_content=f"Guideline section {i}", metadata={"source": "bench.json"}) for i in range(3)]
+
+retriever = RunnableLambda(lambda _query: DOCS)
+llm = FakeListChatModel(responses=["ok"])
+
+
+# ---------- BEFORE: new graph on every request ----------
+def build_chat_chain():
+    return build_rag_chain("chat", CHAT_PREFIX, CHAT_SUFFIX, retriever, llm)
+
+
+# ---------- AFTER: built once, values passed as one mapping ----------
+CHAT_CHAIN = build_chat_chain()
+
+
+def request_values(i):
+    return {
+        "question": f"Can I go for a run? ({i})",
+        "user_profile": "Patient Name: Bench, Age: 30. Condition: Asthma.",
+        "aqi_data": "{'aqi_index': 4, 'pm2_5': 80.1, 'indian_aqi': 167}",
+        "history": "",
+    }
+
+
+def measure(label, fn):
+    fn(0)  # warm up imports / caches
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    for i in range(N):
+        fn(i)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+    print(f"{label:<28} {1e6 * elapsed / N:9.1f} µs/req   peak {peak / 1024:8.1f} KiB   live blocks {blocks}")
+
+
+def build_only_before(_i):
+    build_chat_chain()
+
+
+def build_and_invoke_before(i):
+    build_chat_chain().invoke(request_values(i))
+
+
+def invoke_after(i):
+    CHAT_CHAIN.invoke(request_values(i))
+
+
+if __name__ == "__main__":
+    print(f"{N} requests each (tracemalloc on, absolute numbers are inflated)\n")
+    measure("before: build only", build_only_before)
+    measure("before: build + invoke", build_and_invoke_before)
+    measure("after:  invoke prebuilt", invoke_after)
+
+    t0 = time.perf_counter()
+    CHAT_CHAIN.batch([request_values(i) for i in range(N)])
+    print(f"\nafter:  batch({N})            {1e6 * (time.perf_counter() - t0) / N:9.1f} µs/req")
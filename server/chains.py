@@ -0,0 +1,162 @@
+from operator import itemgetter
+
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda
+from langchain_core.output_parsers import StrOutputParser
+
+from profiler import stage, note
+from prompt_cache import cached_prefix_llm
+
+##Advisory + chat prompts and the RAG chains built from them##
+# Kept out of app.py so the chains can be built without Firebase/Pinecone
+# (bench_chains.py builds the real chains around a fake LLM + retriever).
+
+# ================== PROMPT ==================
+# Each prompt = static PREFIX (same bytes on every call, cacheable by Gemini)
+#             + per-request SUFFIX (template variables only).
+# Never put a {variable} in a prefix, or it stops being cacheable.
+# Both prefixes are well under Gemini's 1024-token minimum for explicit
+# context caching, so these routes rely on its implicit prefix caching
+# (see /api/prompt-cache-stats). Only the SOS prefix, with its pinned
+# protocols, is large enough to be uploaded as a cached content.
+
+#Prompt API1
+ADVISORY_PREFIX = """
+You are Respi-Guard. Analyze the Indian Air Quality (NAQI) and user health.
+Return your response in strictly VALID JSON format.
+
+Structure:
+{
+  "advisory_text": "Medical advice citing sources, but adding practical mitigation (e.g., N95 masks).",
+  "activities": {
+     "outdoor_exercise": {"status": "Avoid", "color": "red"}, 
+     "light_walk": {"status": "Caution (Mask Required)", "color": "yellow"}, 
+     "indoor_ventilation": {"status": "Safe", "color": "green"}
+  }
+}
+
+You will receive CONTEXT (guidelines), USER PROFILE and LIVE AIR QUALITY.
+(Note: 'indian_aqi' follows CPCB standards. >300 is Very Poor.)
+
+INSTRUCTIONS:
+1. **Prioritize Safety but be Pragmatic:** - For "outdoor_exercise": If AQI > 200 (Poor), mark as RED ("Avoid"). Heavy breathing is dangerous.
+   - For "light_walk" (Commute): If AQI is High (200-400), do NOT mark as Red. Mark as YELLOW ("Caution") and strictly advise wearing an N95 Mask. Only mark Red if AQI > 400 (Severe).
+   - For "indoor_ventilation": If AQI > 150, mark as RED ("Close Windows"). Use Air Purifier if possible.
+
+2. ALWAYS mention "N95 Mask" if the status is Yellow or Red.
+3. Cite sources (GINA/WHO).
+"""
+
+ADVISORY_SUFFIX = """
+CONTEXT:
+{context}
+
+USER PROFILE:
+{user_profile}
+
+LIVE AIR QUALITY:
+{aqi_data}
+
+RESPONSE:
+"""
+
+######################################################################################################################
+
+
+
+
+
+
+#Prompt API2
+CHAT_PREFIX = """
+SYSTEM ROLE:
+You are **Respi-Guard**, a specialized Pulmonology AI Assistant. Your sole purpose is to provide respiratory health advice, interpret air quality data, and offer guidance based on clinical protocols.
+
+⛔ STRICT GUARDRAILS (DO NOT IGNORE):
+1. **Scope Restriction**: If the user asks about coding, politics, movies, general trivia, or anything unrelated to health/weather, politely refuse. Say: "I can only assist with respiratory health and air quality monitoring."
+2. **No Hallucinations**: If the answer is not found in the 'CONTEXT' or 'AQI DATA', admit you don't know. Do not invent medical advice.
+3. **Emergency Protocol**: If the user indicates severe distress (e.g., "I can't breathe," "Chest pain"), ignore standard advice and tell them to press the **SOS Button** or call emergency services immediately.
+
+---
+
+📥 YOU WILL RECEIVE:
+1. **CLINICAL CONTEXT** (Guidelines & RAG)
+2. **USER PROFILE** (The Patient)
+3. **REAL-TIME ENVIRONMENT** (Live AQI)
+4. **CONVERSATION HISTORY**
+5. **USER QUESTION**
+
+---
+
+📝 INSTRUCTIONS FOR RESPONSE:
+1. **Personalize**: Always tailor the answer to the User's specific condition and medications listed in 'USER PROFILE'.
+2. **Check the Air**: If the user asks about going outside, exercising, or opening windows, you MUST cross-reference the 'REAL-TIME ENVIRONMENT'.
+   - *Example*: "Since your AQI is 320 (Very Poor) and you have Asthma, stay indoors."
+3. **Cite Sources**: When providing medical facts from the 'CLINICAL CONTEXT', explicitly cite the source (e.g., [Source: GINA Guidelines]).
+4. **Tone**: Professional, empathetic, and concise. Do not use robotic fillers like "As an AI...".
+5. **Format**: Use Markdown (bolding for warnings, bullet points for steps). Do NOT use JSON.
+"""
+
+CHAT_SUFFIX = """
+📥 INPUT DATA:
+1. **CLINICAL CONTEXT** (Guidelines & RAG): 
+{context}
+
+2. **USER PROFILE** (The Patient): 
+{user_profile}
+
+3. **REAL-TIME ENVIRONMENT** (Live AQI): 
+{aqi_data}
+
+4. **CONVERSATION HISTORY**: 
+{history}
+
+---
+
+USER QUESTION: 
+{question}
+
+YOUR RESPONSE:
+"""
+
+
+
+## 1st retrieve ->  format -> send to LLM! ###
+
+# ================== HELPER FUNCTION FOR CONTEXT ==================
+def format_docs(docs):
+    # This combines the JSON chunks and adds the source tag for the LLM
+    formatted = []
+    for doc in docs:
+        source = doc.metadata.get("source", "Unknown Source")
+        formatted.append(f"CONTENT: {doc.page_content}\nSOURCE: {source}\n---")
+    context = "\n".join(formatted)
+    note("context_chars", len(context))
+    return context
+
+
+def context_step(retriever):
+    """question -> retrieved + formatted guideline sections."""
+
+    def retrieve_context(query):
+        with stage("retrieval"):
+            docs = retriever.invoke(query)
+        return format_docs(docs)
+
+    async def aretrieve_context(query):
+        with stage("retrieval"):
+            docs = await retriever.ainvoke(query)
+        return format_docs(docs)
+
+    return itemgetter("question") | RunnableLambda(retrieve_context, afunc=aretrieve_context)
+
+
+# ================== RAG CHAINS ==================
+# Per-request values come in as ONE mapping instead of closures, so a chain
+# is built once and invoke/batch/abatch/stream all work as-is:
+#   chain.invoke({"question": ..., "user_profile": ..., "aqi_data": ..., "history": ...})
+def build_rag_chain(route, prefix, suffix, retriever, llm):
+    return (
+        RunnablePassthrough.assign(context=context_step(retriever))
+        | cached_prefix_llm(route, prefix, suffix, llm)
+        | StrOutputParser()
+    )
@@ -1,30 +1,28 @@
 import os
 import re
+from operator import itemgetter
 from twilio.rest import Client
 from flask import jsonify, request
-from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda
 from langchain_core.output_parsers import StrOutputParser
 
+from admission import llm_gate, Priority
+from profiler import stage, note
+from prompt_cache import cached_prefix_llm, with_pinned_sections
+
 TWILIO_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_FROM = os.getenv("TWILIO_FROM_NUMBER")
 
 
 # ================== SOS PROMPT ==================
-SOS_PROMPT = PromptTemplate.from_template(
-    """
+# Static prefix (cached by Gemini together with the pinned sections below)
+SOS_PREFIX = """
 SYSTEM ROLE:
 You are an Emergency First Responder Voice Guide.
 The user is having an acute asthma attack, is likely panicking, and has already triggered an SOS alert.
 Your ONLY goal is to keep them alive and calm for the next 5 minutes until the ambulance arrives.
 
-CONTEXT (Medical Guidelines):
-{context}
-
-USER AGE:
-{user_age}
-
 ⛔ STRICT CONSTRAINTS:
 1. DO NOT give instructions that take "20 minutes" or "1 hour".
 2. DO NOT mention oral pills (Prednisolone) unless explicitly asked; the user cannot swallow easily right now.
@@ -42,33 +40,63 @@ INSTRUCTIONS FOR RESPONSE:
 
 OUTPUT FORMAT:
 Provide 5 short, numbered, spoken commands designed for Text-to-Speech.
+"""
+
+SOS_SUFFIX = """
+CONTEXT (Medical Guidelines):
+{context}
+
+USER AGE:
+{user_age}
 
 RESPONSE:
 """
+
+# Read out when the LLM cannot answer in time
+STATIC_SOS_INSTRUCTIONS = (
+    "1. Sit up straight. Do not lie down.\n"
+    "2. Loosen your collar and belt.\n"
+    "3. Take your blue reliever inhaler now. Four puffs.\n"
+    "4. Breathe out slowly through pursed lips.\n"
+    "5. Help is on the way. You are doing great."
 )
 
+# Every SOS needs these, so they live in the cached prefix instead of the RAG context
+SOS_PINNED_SECTIONS = {"exacerbation_management_protocols", "inhaler_technique_adherence"}
+
+
 
 
 
+def register_routes(app, retriever, llm, db, guideline_docs=()):
+    sos_prefix = with_pinned_sections(SOS_PREFIX, guideline_docs, SOS_PINNED_SECTIONS)
+    pinned = {d.metadata.get("section") for d in guideline_docs} & SOS_PINNED_SECTIONS
 
-def register_routes(app, retriever, llm, db):
     def format_docs(docs):
-        return "\n".join([d.page_content for d in docs])
-
-    # Accepts condition and medications fetched from firestore
-    def build_sos_chain(user_age, user_condition, user_meds):
-        return (
-            {
-                "context": retriever | format_docs,
-                "question": RunnablePassthrough(),
-                "user_age": lambda _: user_age, 
-                "user_condition": lambda _: user_condition,
-                "user_meds": lambda _: user_meds,
-            }
-            | SOS_PROMPT
-            | llm
-            | StrOutputParser()
+        # Pinned sections are already in the prefix
+        docs = [d for d in docs if d.metadata.get("section") not in pinned]
+        context = "\n".join([d.page_content for d in docs])
+        note("context_chars", len(context))
+        return context
+
+    def retrieve_context(query):
+        with stage("retrieval"):
+            docs = retriever.invoke(query)
+        return format_docs(docs)
+
+    async def aretrieve_context(query):
+        with stage("retrieval"):
+            docs = await retriever.ainvoke(query)
+        return format_docs(docs)
+
+    # Built once per app. Takes {"question", "user_age", "user_condition", "user_meds"}
+    sos_chain = (
+        RunnablePassthrough.assign(
+            context=itemgetter("question") | RunnableLambda(retrieve_context, afunc=aretrieve_context)
         )
+        | cached_prefix_llm("sos", sos_prefix, SOS_SUFFIX, llm)
+        | StrOutputParser()
+    )
 
     # ================== ROUTE 1: SMART SOS ALERT ==================
     @app.route("/api/sos-alert", methods=["POST"])
@@ -96,7 +124,8 @@ def register_routes(app, retriever, llm, db):
 
         if db and uid:
             try:
-                user_doc = db.collection('users').document(uid).get()
+                with stage("profile_db"):
+                    user_doc = db.collection('users').document(uid).get()
                 if user_doc.exists:
                     user_data = user_doc.to_dict()
                     
@@ -136,16 +165,8 @@ def register_routes(app, retriever, llm, db):
         # Sanitize Phone
         guardian_phone = re.sub(r"[^\d+]", "", raw_phone)
 
-        # 4. GENERATE PERSONALIZED VOICE INSTRUCTIONS
-        print(f"🚨 SOS: {condition} / {meds}")
-        
-        # Pass all medical context to the LLM Chain
-        chain = build_sos_chain(user_age, condition, meds) 
-        
-        # We ask a broader question now to cover dizziness/choking
-        voice_instructions = chain.invoke("Immediate emergency steps for respiratory distress")
-
-        # 5. CONSTRUCT RICH WHATSAPP MESSAGE
+        # 4. CONSTRUCT RICH WHATSAPP MESSAGE
+        # Guardians are alerted FIRST, so a busy or slow LLM can never delay them
         msg_body = (
             f"⚠️ *SOS: RESPIRATORY EMERGENCY*\n"
             f"👤 *Patient*: {user_name} ({user_age})\n"
@@ -159,18 +180,19 @@ def register_routes(app, retriever, llm, db):
         msg_status = "Skipped"
 
 
-        # ###############6. TWILIO ACTS ###############
+        # ###############5. TWILIO ACTS ###############
         if TWILIO_SID and TWILIO_AUTH and TWILIO_FROM:
             try:
                 client = Client(TWILIO_SID, TWILIO_AUTH)
                 
                 # --- A: WHATSAPP ---
                 print("📨 Sending WhatsApp...")
-                message = client.messages.create(
-                    body=msg_body,
-                    from_='whatsapp:+14155238886', 
-                    to=f'whatsapp:{guardian_phone}'
-                )
+                with stage("twilio_whatsapp"):
+                    message = client.messages.create(
+                        body=msg_body,
+                        from_='whatsapp:+14155238886', 
+                        to=f'whatsapp:{guardian_phone}'
+                    )
                 msg_status = f"WhatsApp Sent ({message.sid})"
                 print(f"✅ WhatsApp Sent: {message.sid}")
 
@@ -188,11 +210,12 @@ def register_routes(app, retriever, llm, db):
                     f"</Response>"
                 )
 
-                call = client.calls.create(
-                    twiml=twiml_script,
-                    to=guardian_phone,
-                    from_=TWILIO_FROM 
-                )
+                with stage("twilio_call"):
+                    call = client.calls.create(
+                        twiml=twiml_script,
+                        to=guardian_phone,
+                        from_=TWILIO_FROM 
+                    )
                 call_status = f"Calling ({call.sid})"
                 print(f"✅ Call Placed: {call.sid}")
 
@@ -201,6 +224,30 @@ def register_routes(app, retriever, llm, db):
                 msg_status = f"Failed: {str(e)}"
                 call_status = f"Failed: {str(e)}"
 
+        # 6. GENERATE PERSONALIZED VOICE INSTRUCTIONS
+        print(f"🚨 SOS: {condition} / {meds}")
+        
+        # Pass all medical context to the LLM Chain
+        # We ask a broader question now to cover dizziness/choking
+        chain_input = {
+            "question": "Immediate emergency steps for respiratory distress",
+            "user_age": user_age,
+            "user_condition": condition,
+            "user_meds": meds,
+        }
+
+        # SOS jumps the LLM queue and is never rate limited.
+        # If no slot frees up in time (or Gemini fails) the patient still gets guidance.
+        try:
+            with llm_gate.slot(Priority.SOS, uid) as waited:
+                note("llm_queue_ms", round(1000 * waited, 1))
+                with stage("rag_chain"):
+                    voice_instructions = sos_chain.invoke(chain_input)
+        except Exception as e:
+            print(f"⚠️ SOS voice generation failed ({e}), using static instructions")
+            note("sos_voice", "static_fallback")
+            voice_instructions = STATIC_SOS_INSTRUCTIONS
+
         return jsonify({
             "status": "SOS Activated",
             "voice_text": voice_instructions,
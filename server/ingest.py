@@ -11,14 +11,9 @@ from langchain_pinecone import PineconeVectorStore
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 
 # ================== CONFIG ==================
-DOCS_FOLDER = "medical_docs"
+DOCS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "medical_docs")
 INDEX_NAME = "respi-guard"
 
-# KEEPING YOUR MODEL AS REQUESTED
-embeddings = GoogleGenerativeAIEmbeddings(
-    model="models/text-embedding-004" 
-)
-
 # ================== INGEST LOGIC ==================
 
 def make_doc(text: str, metadata: dict) -> Document:
@@ -31,16 +26,19 @@ def make_doc(text: str, metadata: dict) -> Document:
     metadata["doc_id"] = doc_id
     return Document(page_content=text, metadata=metadata)
 
-def ingest_docs():
-    print("🚀 Starting Smart Contextual Ingestion...")
-    
+def build_documents(folder: str = DOCS_FOLDER) -> List[Document]:
+    """
+    Turns every JSON guideline into one Document per top-level section.
+    Shared by Pinecone ingestion and the in-memory BM25 index (retrieval.py),
+    so both sides agree on chunks, metadata and doc_id.
+    """
     documents: List[Document] = []
 
-    for filename in os.listdir(DOCS_FOLDER):
+    for filename in sorted(os.listdir(folder)):
         if not filename.endswith(".json"):
             continue
 
-        path = os.path.join(DOCS_FOLDER, filename)
+        path = os.path.join(folder, filename)
         print(f"📦 Processing {filename}...")
 
         with open(path, "r", encoding="utf-8") as f:
@@ -81,6 +79,13 @@ def ingest_docs():
                 }
                 documents.append(make_doc(text_content, metadata))
 
+    return documents
+
+
+def ingest_docs():
+    print("🚀 Starting Smart Contextual Ingestion...")
+
+    documents = build_documents()
     print(f"📄 Created {len(documents)} Context-Rich Documents.")
     
     # Optional: If a section is HUGE, we might want to split it.
@@ -88,6 +93,10 @@ def ingest_docs():
     # We will upload as-is for maximum context.
 
     print("⏳ Uploading to Pinecone...")
+    # KEEPING YOUR MODEL AS REQUESTED
+    embeddings = GoogleGenerativeAIEmbeddings(
+        model="models/text-embedding-004" 
+    )
     vectorstore = PineconeVectorStore(
         index_name=INDEX_NAME,
         embedding=embeddings,
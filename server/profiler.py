@@ -0,0 +1,224 @@
+import os
+import sys
+import hmac
+import time
+import threading
+import contextvars
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from flask import jsonify, request, Response
+
+##On-demand profiling + slow request capture##
+# 1. Every traced request carries a small timeline (stages, prompt sizes,
+#    upstream timings). If it ends slower than SLOW_REQUEST_MS it is kept in a
+#    bounded ring buffer that admins can query.
+# 2. Admins can switch on a sampling profiler for selected routes. It wakes up
+#    every few ms, grabs the stacks of the threads serving those routes and
+#    counts them as collapsed stacks (feed to flamegraph.pl / speedscope).
+# When nothing is enabled the cost is one dict + a few perf_counter() calls.
+# Both live in the gunicorn worker that served the admin request: responses
+# carry its pid, repeat the call to reach the other workers.
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "3000"))
+SLOW_REQUEST_BUFFER = int(os.getenv("SLOW_REQUEST_BUFFER", "50"))
+
+TRACED_ROUTES = {"/api/get-advisory", "/api/ask-doctor", "/api/sos-alert"}
+
+_current = contextvars.ContextVar("respi_trace", default=None)
+slow_requests = deque(maxlen=SLOW_REQUEST_BUFFER)
+
+
+# ================== REQUEST TIMELINE ==================
+class RequestTrace:
+    def __init__(self, path):
+        self.path = path
+        self.started_at = time.time()
+        self.t0 = time.perf_counter()
+        self.stages = []
+        self.notes = {}
+
+    def to_dict(self, total_ms):
+        return {
+            "path": self.path,
+            "started_at": self.started_at,
+            "total_ms": round(total_ms, 1),
+            "stages": self.stages,
+            "notes": self.notes,
+        }
+
+
+@contextmanager
+def stage(name):
+    """Times a block of work (DB read, AQI fetch, LLM call...) on the current request."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    # LangChain runs parallel steps on executor threads (the trace is in the
+    # copied context): sample those under the request's route too
+    sampled = sampler.enter(trace.path)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if sampled:
+            sampler.leave()
+        end = time.perf_counter()
+        trace.stages.append({
+            "stage": name,
+            "start_ms": round(1000 * (start - trace.t0), 1),
+            "duration_ms": round(1000 * (end - start), 1),
+        })
+
+
+def note(key, value):
+    """Attaches a value (prompt size, cache hit...) to the current request."""
+    trace = _current.get()
+    if trace is not None:
+        trace.notes[key] = value
+
+
+# ================== SAMPLING PROFILER ==================
+class SamplingProfiler:
+    def __init__(self):
+        self.routes = set()
+        self.interval = 0.005
+        self.samples = Counter()
+        self.active_threads = {}        # thread ident -> route
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, routes, interval_ms=5):
+        self.stop()
+        self.routes = set(routes) or set(TRACED_ROUTES)
+        self.interval = max(interval_ms, 1) / 1000.0
+        with self._lock:
+            self.samples.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="respi-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+        self._thread = None
+
+    def enter(self, route):
+        """Samples the current thread under `route`; True if this call registered it."""
+        ident = threading.get_ident()
+        if self.running and route in self.routes and ident not in self.active_threads:
+            self.active_threads[ident] = route
+            return True
+        return False
+
+    def leave(self):
+        self.active_threads.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.active_threads:
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, route in list(self.active_threads.items()):
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        self.samples[_collapse(route, frame)] += 1
+
+    def collapsed(self):
+        with self._lock:
+            return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
+
+
+def _collapse(route, frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    stack.append(route)
+    return ";".join(reversed(stack))
+
+
+sampler = SamplingProfiler()
+
+
+# ================== FLASK WIRING ==================
+def _is_admin():
+    token = request.headers.get("X-Admin-Token") or ""
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+def register_routes(app):
+    @app.before_request
+    def _start_trace():
+        if request.path in TRACED_ROUTES:
+            _current.set(RequestTrace(request.path))
+            sampler.enter(request.path)
+
+    @app.teardown_request
+    def _end_trace(_exc):
+        trace = _current.get()
+        if trace is None:
+            return
+        _current.set(None)
+        sampler.leave()
+        total_ms = 1000 * (time.perf_counter() - trace.t0)
+        if total_ms >= SLOW_REQUEST_MS:
+            slow_requests.append(trace.to_dict(total_ms))
+            print(f"🐢 Slow request captured: {trace.path} took {total_ms:.0f}ms")
+
+    @app.route("/api/admin/profiler", methods=["GET", "POST"])
+    def profiler_control():
+        if not _is_admin():
+            return jsonify({"error": "Forbidden"}), 403
+
+        if request.method == "GET":
+            # Collapsed stacks: "route;file:func:line;... count"
+            return Response(sampler.collapsed(), mimetype="text/plain", headers={"X-Worker-Pid": str(os.getpid())})
+
+        data = request.get_json(silent=True) or {}
+        action = data.get("action")
+        if action == "start":
+            routes = data.get("routes", [])
+            interval_ms = data.get("interval_ms", 5)
+            if not isinstance(routes, list) or not all(isinstance(r, str) for r in routes):
+                return jsonify({"error": "routes must be a list of paths"}), 400
+            if isinstance(interval_ms, bool) or not isinstance(interval_ms, (int, float)) or not 1 <= interval_ms <= 1000:
+                return jsonify({"error": "interval_ms must be a number between 1 and 1000"}), 400
+            sampler.start(routes, interval_ms)
+        elif action == "stop":
+            sampler.stop()
+        else:
+            return jsonify({"error": "action must be 'start' or 'stop'"}), 400
+
+        return jsonify({
+            "pid": os.getpid(),
+            "running": sampler.running,
+            "routes": sorted(sampler.routes),
+            "interval_ms": round(sampler.interval * 1000),
+        })
+
+    @app.route("/api/admin/slow-requests", methods=["GET"])
+    def get_slow_requests():
+        if not _is_admin():
+            return jsonify({"error": "Forbidden"}), 403
+
+        path = request.args.get("path")
+        try:
+            min_ms = float(request.args.get("min_ms", 0))
+        except ValueError:
+            return jsonify({"error": "min_ms must be a number"}), 400
+        items = [
+            r for r in slow_requests
+            if (not path or r["path"] == path) and r["total_ms"] >= min_ms
+        ]
+        return jsonify({"pid": os.getpid(), "threshold_ms": SLOW_REQUEST_MS, "requests": items[::-1]})
@@ -0,0 +1,268 @@
+import os
+import time
+import hashlib
+import threading
+
+from langchain_core.messages import SystemMessage
+from langchain_core.messages.ai import add_usage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda, RunnableGenerator
+
+from shared_cache import TieredCache
+
+##Static prompt prefixes + Gemini context caching##
+# Every prompt is split into:
+#   PREFIX : role, guardrails, instructions (+ optional pinned guideline
+#            sections). Identical on every call.
+#   SUFFIX : retrieved context, profile, AQI, history, question.
+# With PROMPT_CACHE_BACKEND=gemini the prefix is uploaded once as a Gemini
+# cached content (system instruction) and calls only send the suffix.
+# PROMPT_CACHE_BACKEND=local is an in-process stand-in for tests/dev (use it
+# with a fake LLM), =off always sends the full prompt inline.
+# Gemini only caches prompts above a minimum size (1024 tokens on 2.5 Flash);
+# smaller prefixes are always sent inline and rely on Gemini's implicit
+# caching of repeated prompt prefixes (reported as cache_read tokens too).
+# A cached content Gemini has already deleted fails the call: the name is
+# dropped and the call is retried inline.
+
+PROMPT_CACHE_BACKEND = os.getenv("PROMPT_CACHE_BACKEND", "gemini")
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", "3600"))
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))
+PROMPT_CACHE_RETRY_AFTER = 60  # seconds before retrying a failed caches.create
+
+
+def estimate_tokens(text):
+    # ~4 characters per token; only used to skip prefixes too small to cache
+    return len(text) // 4
+
+
+def prefix_hash(prefix):
+    return hashlib.sha256(prefix.encode()).hexdigest()[:16]
+
+
+def cache_key(prefix, model):
+    return f"{model}:{prefix_hash(prefix)}"
+
+
+def _is_too_small(error):
+    text = str(error).lower()
+    return "too small" in text or "min_total_token_count" in text
+
+
+def _is_stale_cache(error):
+    # 403/404 from Gemini when the cached content expired or was deleted
+    text = str(error).lower()
+    return "cachedcontent" in text.replace(" ", "") or "cached content" in text
+
+
+def with_pinned_sections(prefix, documents, sections):
+    """Appends always-needed guideline sections to a prefix so they are cached too."""
+    pinned = [d for d in documents if d.metadata.get("section") in sections]
+    if not pinned:
+        return prefix
+    body = "\n".join(f"CONTENT: {d.page_content}\nSOURCE: {d.metadata.get('source')}\n---" for d in pinned)
+    return f"{prefix}\n\nREFERENCE GUIDELINES (always available):\n{body}"
+
+
+# ================== CACHE BACKENDS ==================
+class GeminiContextCache:
+    """Creates one Gemini cached content per (model, prefix), shared by all workers."""
+
+    def __init__(self, ttl):
+        from google import genai   # ships with langchain-google-genai
+        from google.genai import types
+
+        self._client = genai.Client()
+        self._types = types
+        self.ttl = ttl
+        self._names = TieredCache("prompt_prefix")
+        self._unsupported = set()
+        self._failed_at = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()   # guards _key_locks only
+
+    def lookup(self, route, prefix, model):
+        key = cache_key(prefix, model)
+        if key in self._unsupported:
+            return None
+        name = self._names.get(key)
+        if name:
+            return name
+        if estimate_tokens(prefix) < PROMPT_CACHE_MIN_TOKENS:
+            print(f"ℹ️ {route} prompt prefix is below {PROMPT_CACHE_MIN_TOKENS} tokens, sending it inline")
+            self._unsupported.add(key)
+            return None
+        if time.time() - self._failed_at.get(key, 0) < PROMPT_CACHE_RETRY_AFTER:
+            return None
+
+        # One upload per prefix; other routes never wait behind it
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            name = self._names.get(key)
+            if name:
+                return name
+            try:
+                cache = self._client.caches.create(
+                    model=model if model.startswith("models/") else f"models/{model}",
+                    config=self._types.CreateCachedContentConfig(
+                        display_name=f"respi-guard-{route}-{prefix_hash(prefix)[:8]}",
+                        system_instruction=prefix,
+                        ttl=f"{self.ttl}s",
+                    ),
+                )
+            except Exception as e:
+                print(f"⚠️ Context cache unavailable for {route}: {e}")
+                if _is_too_small(e):
+                    self._unsupported.add(key)      # send this prefix inline from now on
+                else:
+                    self._failed_at[key] = time.time()   # quota/network: try again later
+                return None
+
+            # Stop handing the name out a minute before Gemini deletes it
+            self._names.set(key, cache.name, max(self.ttl - 60, 1))
+            print(f"📌 Cached {route} prompt prefix as {cache.name}")
+            return cache.name
+
+    def invalidate(self, prefix, model):
+        self._names.delete(cache_key(prefix, model))
+
+
+class LocalContextCache:
+    """Test stand-in: hands out fake cache names, never talks to Gemini."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.created = {}
+
+    def lookup(self, route, prefix, model):
+        key = cache_key(prefix, model)
+        entry = self.created.get(key)
+        if not entry or entry[1] < time.time():
+            entry = (f"local/{route}/{prefix_hash(prefix)}", time.time() + self.ttl)
+            self.created[key] = entry
+        return entry[0]
+
+    def invalidate(self, prefix, model):
+        self.created.pop(cache_key(prefix, model), None)
+
+
+def _make_backend():
+    if PROMPT_CACHE_BACKEND == "local":
+        return LocalContextCache(PROMPT_CACHE_TTL)
+    if PROMPT_CACHE_BACKEND == "gemini":
+        try:
+            return GeminiContextCache(PROMPT_CACHE_TTL)
+        except Exception as e:
+            print(f"⚠️ Gemini context caching disabled: {e}")
+    return None
+
+
+context_cache = _make_backend()
+
+
+# ================== TOKEN METRICS ==================
+class PromptTokenMetrics:
+    def __init__(self):
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, usage, cached_call):
+        with self._lock:
+            stats = self.routes.setdefault(route, {
+                "calls": 0, "cached_calls": 0, "calls_without_usage": 0, "input_tokens": 0,
+                "cached_input_tokens": 0, "uncached_input_tokens": 0,
+            })
+            stats["calls"] += 1
+            stats["cached_calls"] += int(cached_call)
+            if not usage:
+                # Fake/local LLM: token counts are unknown, don't guess
+                stats["calls_without_usage"] += 1
+                return
+            input_tokens = usage.get("input_tokens", 0)
+            cached = (usage.get("input_token_details") or {}).get("cache_read", 0)
+            stats["input_tokens"] += input_tokens
+            stats["cached_input_tokens"] += cached
+            stats["uncached_input_tokens"] += input_tokens - cached
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "backend": PROMPT_CACHE_BACKEND if context_cache else "off",
+                "routes": {
+                    route: {
+                        **stats,
+                        "cached_ratio": round(stats["cached_input_tokens"] / stats["input_tokens"], 3)
+                        if stats["input_tokens"] else None,
+                    }
+                    for route, stats in self.routes.items()
+                },
+            }
+
+
+prompt_metrics = PromptTokenMetrics()
+
+
+def _usage_tap(route, cached_call):
+    """Passes LLM output through untouched (streaming too) and records its token usage."""
+
+    # Streamed chunks carry usage deltas, so they are summed
+    def tap(chunks):
+        usage = None
+        for chunk in chunks:
+            if getattr(chunk, "usage_metadata", None):
+                usage = add_usage(usage, chunk.usage_metadata)
+            yield chunk
+        prompt_metrics.record(route, usage, cached_call)
+
+    async def atap(chunks):
+        usage = None
+        async for chunk in chunks:
+            if getattr(chunk, "usage_metadata", None):
+                usage = add_usage(usage, chunk.usage_metadata)
+            yield chunk
+        prompt_metrics.record(route, usage, cached_call)
+
+    return RunnableGenerator(tap, atap)
+
+
+# ================== PROMPT + MODEL STEP ==================
+def cached_prefix_llm(route, prefix, suffix_template, llm):
+    """
+    Prompt variables -> AIMessage. Sends only the suffix when the prefix is in
+    the context cache, otherwise prefix (system) + suffix (human) inline.
+    """
+    full_prompt = ChatPromptTemplate.from_messages([SystemMessage(content=prefix), ("human", suffix_template)])
+    suffix_prompt = ChatPromptTemplate.from_messages([("human", suffix_template)])
+    model = getattr(llm, "model", "")
+
+    inline = full_prompt | llm | _usage_tap(route, False)
+
+    def retry_inline(inputs):
+        error = inputs.pop("cache_error")
+        if not _is_stale_cache(error):
+            raise error
+        print(f"♻️ Cached {route} prefix is gone, retrying inline")
+        context_cache.invalidate(prefix, model)
+        return inputs
+
+    fallback = RunnableLambda(retry_inline) | inline
+
+    # Built once per cache name (a new name only every PROMPT_CACHE_TTL)
+    by_name = {}
+
+    def cached(name):
+        chain = by_name.get(name)
+        if chain is None:
+            chain = (suffix_prompt | llm.bind(cached_content=name) | _usage_tap(route, True)).with_fallbacks(
+                [fallback], exception_key="cache_error"
+            )
+            by_name.clear()
+            by_name[name] = chain
+        return chain
+
+    def pick(_inputs):
+        name = context_cache.lookup(route, prefix, model) if context_cache else None
+        return cached(name) if name else inline
+
+    return RunnableLambda(pick)
@@ -0,0 +1,175 @@
+import re
+import math
+from collections import Counter, defaultdict
+from typing import Any, Dict, List
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import RunnableLambda
+
+from profiler import note
+
+##Hybrid retrieval over the guideline corpus##
+# 1. Route-aware metadata prefilter (doc_type from ingest.infer_doc_type):
+#    SOS/chat only see clinical guidelines, advisories see environmental + clinical.
+# 2. BM25 over an in-memory inverted index built at startup from medical_docs/
+#    (same chunks + doc_id as the Pinecone ingestion).
+# 3. Vector search in Pinecone with the same doc_type filter.
+# 4. Reciprocal Rank Fusion of both lists.
+# Short exact-term queries ("Salbutamol") that BM25 answers fully skip the
+# embedding call entirely.
+
+ROUTE_DOC_TYPES = {
+    "sos": ["Clinical_Guideline"],
+    "chat": ["Clinical_Guideline"],
+    "advisory": ["Environmental_Guideline", "Clinical_Guideline"],
+}
+# Sharper candidates = fewer sections in the prompt
+ROUTE_K = {"sos": 2, "chat": 3, "advisory": 3}
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "for", "from", "how", "i",
+    "if", "in", "is", "it", "me", "my", "of", "on", "or", "should", "the", "to", "what",
+    "when", "with", "you", "your",
+}
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+
+
+def tokenize(text):
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+def doc_key(doc):
+    return doc.metadata.get("doc_id") or doc.page_content
+
+
+# ================== BM25 ==================
+class BM25Index:
+    """Okapi BM25 with postings, doc lengths and idf precomputed once."""
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)         # term -> [(doc_idx, tf)]
+        self.doc_len = []
+        self.by_doc_type = defaultdict(set)       # doc_type -> {doc_idx}
+
+        for idx, doc in enumerate(documents):
+            tokens = tokenize(doc.page_content)
+            self.doc_len.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                self.postings[term].append((idx, tf))
+            self.by_doc_type[doc.metadata.get("doc_type")].add(idx)
+
+        n = len(documents)
+        self.avgdl = (sum(self.doc_len) / n) if n else 0.0
+        self.idf = {
+            term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5))
+            for term, p in self.postings.items()
+        }
+
+    def allowed(self, doc_types):
+        allowed = set()
+        for doc_type in doc_types:
+            allowed |= self.by_doc_type.get(doc_type, set())
+        return allowed
+
+    def search(self, terms, allowed, k):
+        """Top-k (doc_idx, score, matched_terms) among `allowed` docs."""
+        scores = defaultdict(float)
+        matched = defaultdict(set)
+        for term in set(terms):
+            for idx, tf in self.postings.get(term, ()):
+                if idx not in allowed:
+                    continue
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[idx] / self.avgdl)
+                scores[idx] += self.idf[term] * tf * (self.k1 + 1) / norm
+                matched[idx].add(term)
+        top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(idx, score, matched[idx]) for idx, score in top]
+
+
+# ================== HYBRID RETRIEVER ==================
+class HybridRetriever(BaseRetriever):
+    vectorstore: Any
+    index: Any
+    doc_types: List[str]
+    k: int = 3
+    fetch_k: int = 8
+    rrf_k: int = 60
+    exact_max_terms: int = 3
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        terms = tokenize(query)
+        allowed = self.index.allowed(self.doc_types)
+        lexical = self.index.search(terms, allowed, self.fetch_k)
+
+        # Exact-term lookup: every query term found in the best lexical hit
+        unique_terms = set(terms)
+        if unique_terms and len(unique_terms) <= self.exact_max_terms and lexical and lexical[0][2] == unique_terms:
+            note("retrieval_mode", "bm25_only")
+            return [self.index.documents[idx] for idx, _, _ in lexical[: self.k]]
+
+        note("retrieval_mode", "hybrid")
+        vector_docs = self.vectorstore.similarity_search(
+            query, k=self.fetch_k, filter={"doc_type": {"$in": self.doc_types}}
+        )
+
+        # Reciprocal Rank Fusion
+        fused: Dict[str, float] = defaultdict(float)
+        docs_by_key: Dict[str, Document] = {}
+        for rank, (idx, _, _) in enumerate(lexical):
+            doc = self.index.documents[idx]
+            fused[doc_key(doc)] += 1.0 / (self.rrf_k + rank + 1)
+            docs_by_key.setdefault(doc_key(doc), doc)
+        for rank, doc in enumerate(vector_docs):
+            fused[doc_key(doc)] += 1.0 / (self.rrf_k + rank + 1)
+            docs_by_key.setdefault(doc_key(doc), doc)
+
+        ranked = sorted(fused, key=fused.get, reverse=True)[: self.k]
+        return [docs_by_key[key] for key in ranked]
+
+
+# ================== CACHED PER-ROUTE RETRIEVERS ==================
+def cached_retriever(retriever, route, cache, ttl):
+    """Wraps a retriever so repeated queries on a route come from the shared cache."""
+
+    def to_cache(docs):
+        return [{"page_content": d.page_content, "metadata": d.metadata} for d in docs]
+
+    def search(query):
+        hit = cache.get(f"{route}:{query}")
+        if hit is not None:
+            note("retrieval_cache", "hit")
+            return [Document(**d) for d in hit]
+        docs = retriever.invoke(query)
+        cache.set(f"{route}:{query}", to_cache(docs), ttl)
+        return docs
+
+    async def asearch(query):
+        hit = cache.get(f"{route}:{query}")
+        if hit is not None:
+            note("retrieval_cache", "hit")
+            return [Document(**d) for d in hit]
+        docs = await retriever.ainvoke(query)
+        cache.set(f"{route}:{query}", to_cache(docs), ttl)
+        return docs
+
+    return RunnableLambda(search, afunc=asearch)
+
+
+def build_route_retrievers(vectorstore, documents, cache, ttl):
+    """{"sos": ..., "chat": ..., "advisory": ...} sharing one BM25 index."""
+    index = BM25Index(documents)
+    print(f"🔎 BM25 index ready: {len(documents)} sections, {len(index.postings)} terms")
+    return {
+        route: cached_retriever(
+            HybridRetriever(vectorstore=vectorstore, index=index, doc_types=doc_types, k=ROUTE_K[route]),
+            route, cache, ttl,
+        )
+        for route, doc_types in ROUTE_DOC_TYPES.items()
+    }
@@ -0,0 +1,283 @@
+import os
+import json
+import mmap
+import time
+import struct
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows dev machines: shared tier is simply disabled
+    fcntl = None
+
+##Two-tier cache shared by all gunicorn workers on a host##
+# L1: small per-process LRU (dict lookups, no copying)
+# L2: one mmap'd file (default /dev/shm) that every worker maps
+#
+# L2 layout (little endian):
+#   file header : magic "RGC1" | n_sets u32 | ways u32 | slot_size u32
+#   slot        : seq u32 | key 16s | expires_at f64 | last_access f64 | length u32 | payload
+# Slots are grouped into sets of `ways` (set-associative, like a CPU cache).
+# A key can only live in set hash(key) % n_sets; when the set is full the
+# least recently used (or an expired) slot is overwritten.
+#
+# Reads are lock-free (seqlock): the writer bumps `seq` to odd, writes, bumps
+# to even. A reader copies the slot and retries if seq was odd or changed.
+# Writers take one of STRIPES locks (thread lock + fcntl byte-range lock) so
+# writers in different sets never block each other.
+#
+# The geometry is part of the file name (respi-guard-256x8x16384.cache), so
+# workers started with different settings never share a file. A mapped file
+# is never truncated (other workers would SIGBUS): a bad file is replaced by
+# renaming a fresh one over it.
+
+SHARED_CACHE_ENABLED = os.getenv("SHARED_CACHE_ENABLED", "1") == "1"
+SHARED_CACHE_PATH = os.getenv(
+    "SHARED_CACHE_PATH",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "respi-guard.cache"),
+)
+SHARED_CACHE_SETS = int(os.getenv("SHARED_CACHE_SETS", "256"))
+SHARED_CACHE_WAYS = int(os.getenv("SHARED_CACHE_WAYS", "8"))
+SHARED_CACHE_SLOT_KB = int(os.getenv("SHARED_CACHE_SLOT_KB", "16"))
+LOCAL_CACHE_SIZE = int(os.getenv("LOCAL_CACHE_SIZE", "256"))
+
+MAGIC = b"RGC1"
+FILE_HEADER = struct.Struct("<4sIII")
+SLOT_HEADER = struct.Struct("<I16sddI")
+SEQ = struct.Struct("<I")
+STRIPES = 64
+FILE_HEADER_SIZE = 64
+
+
+# ================== L2: SHARED MEMORY ==================
+class SharedMemoryCache:
+    def __init__(self, path, n_sets, ways, slot_size):
+        self.path = path
+        self.n_sets = n_sets
+        self.ways = ways
+        self.slot_size = slot_size
+        self.max_payload = slot_size - SLOT_HEADER.size
+        size = FILE_HEADER_SIZE + n_sets * ways * slot_size
+
+        self._lock_fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        self._thread_locks = [threading.Lock() for _ in range(STRIPES)]
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Only one worker (re)initialises the file; the others wait here
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX, 1, STRIPES)
+            try:
+                # Another worker may have replaced the file while we waited: use its copy
+                if not _same_file(fd, path):
+                    fresh_fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+                    os.close(fd)
+                    fd = fresh_fd
+                header = os.pread(fd, FILE_HEADER.size, 0)
+                expected = FILE_HEADER.pack(MAGIC, n_sets, ways, slot_size)
+                current_size = os.fstat(fd).st_size
+                if current_size == 0:
+                    # Brand new file, nobody has it mapped yet
+                    os.ftruncate(fd, size)  # zero filled = every slot empty
+                    os.pwrite(fd, expected, 0)
+                elif current_size != size or header != expected:
+                    fresh_fd = _replace_file(path, size, expected)
+                    os.close(fd)
+                    fd = fresh_fd
+            finally:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, STRIPES)
+            self._mm = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+
+    def _slot_offset(self, set_index, way):
+        return FILE_HEADER_SIZE + (set_index * self.ways + way) * self.slot_size
+
+    def _read_slot(self, off):
+        """Consistent (header, payload) copy of a slot, or None if a writer kept racing us."""
+        mm = self._mm
+        for _ in range(4):
+            seq = SEQ.unpack_from(mm, off)[0]
+            if seq & 1:
+                continue
+            header = SLOT_HEADER.unpack_from(mm, off)
+            length = min(header[4], self.max_payload)
+            payload = mm[off + SLOT_HEADER.size: off + SLOT_HEADER.size + length]
+            if SEQ.unpack_from(mm, off)[0] == seq:
+                return header, payload
+        return None
+
+    def get(self, digest, set_index):
+        now = time.time()
+        for way in range(self.ways):
+            off = self._slot_offset(set_index, way)
+            slot = self._read_slot(off)
+            if slot is None:
+                continue
+            (_seq, key, expires_at, _last, _length), payload = slot
+            if key == digest and expires_at > now:
+                # Benign race: only used to pick an eviction victim
+                struct.pack_into("<d", self._mm, off + 28, now)
+                return payload
+        return None
+
+    def set(self, digest, set_index, payload, ttl):
+        if len(payload) > self.max_payload:
+            return False
+
+        stripe = set_index % STRIPES
+        now = time.time()
+        with self._thread_locks[stripe]:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                victim, victim_score = None, None
+                for way in range(self.ways):
+                    off = self._slot_offset(set_index, way)
+                    _seq, key, expires_at, last_access, _length = SLOT_HEADER.unpack_from(self._mm, off)
+                    if key == digest:
+                        victim = off
+                        break
+                    # Expired/empty slots first, then least recently used
+                    score = -1.0 if expires_at <= now else last_access
+                    if victim is None or score < victim_score:
+                        victim, victim_score = off, score
+
+                seq = SEQ.unpack_from(self._mm, victim)[0]
+                SEQ.pack_into(self._mm, victim, seq + 1)            # odd: write in progress
+                SLOT_HEADER.pack_into(self._mm, victim, seq + 1, digest, now + ttl, now, len(payload))
+                self._mm[victim + SLOT_HEADER.size: victim + SLOT_HEADER.size + len(payload)] = payload
+                SEQ.pack_into(self._mm, victim, seq + 2)            # even: readable again
+            finally:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, stripe)
+        return True
+
+
+def _same_file(fd, path):
+    try:
+        return os.path.samestat(os.fstat(fd), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+def _replace_file(path, size, header):
+    """Builds a fresh file next to `path` and renames it over it; old mappings keep the old inode."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.ftruncate(fd, size)
+        os.pwrite(fd, header, 0)
+        os.replace(tmp, path)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp)
+        raise
+    return fd
+
+
+def shared_cache_file(base, n_sets, ways, slot_size):
+    """/dev/shm/respi-guard.cache -> /dev/shm/respi-guard-256x8x16384.cache"""
+    root, ext = os.path.splitext(base)
+    return f"{root}-{n_sets}x{ways}x{slot_size}{ext}"
+
+
+def _open_shared_tier():
+    if not SHARED_CACHE_ENABLED or fcntl is None:
+        return None
+    slot_size = SHARED_CACHE_SLOT_KB * 1024
+    path = shared_cache_file(SHARED_CACHE_PATH, SHARED_CACHE_SETS, SHARED_CACHE_WAYS, slot_size)
+    try:
+        shared = SharedMemoryCache(path, SHARED_CACHE_SETS, SHARED_CACHE_WAYS, slot_size)
+        print(f"🧠 Shared cache mapped at {path}")
+        return shared
+    except Exception as e:
+        print(f"⚠️ Shared cache disabled: {e}")
+        return None
+
+
+shared_tier = _open_shared_tier()
+
+
+# ================== L1 + L2 FRONT ==================
+caches = {}
+
+
+class TieredCache:
+    """JSON-serialisable values by string key, within one namespace (aqi, retrieval...)."""
+
+    def __init__(self, namespace, local_size=LOCAL_CACHE_SIZE):
+        self.namespace = namespace
+        self.local_size = local_size
+        self._local = OrderedDict()     # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.stats = {
+            "local": {"hits": 0, "misses": 0},
+            "shared": {"hits": 0, "misses": 0},
+            "shared_oversize": 0,
+        }
+        caches[namespace] = self
+
+    def _digest(self, key):
+        digest = hashlib.blake2b(f"{self.namespace}\0{key}".encode(), digest_size=16).digest()
+        return digest, int.from_bytes(digest[:8], "little") % SHARED_CACHE_SETS
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._local.get(key)
+            if item and item[0] > now:
+                self._local.move_to_end(key)
+                self.stats["local"]["hits"] += 1
+                return item[1]
+            self.stats["local"]["misses"] += 1
+
+        if shared_tier is None:
+            return None
+
+        digest, set_index = self._digest(key)
+        payload = shared_tier.get(digest, set_index)
+        with self._lock:
+            if payload is None:
+                self.stats["shared"]["misses"] += 1
+                return None
+            self.stats["shared"]["hits"] += 1
+
+        envelope = json.loads(payload)
+        self._set_local(key, envelope["v"], envelope["e"])
+        return envelope["v"]
+
+    def set(self, key, value, ttl):
+        expires_at = time.time() + ttl
+        self._set_local(key, value, expires_at)
+
+        if shared_tier is not None:
+            payload = json.dumps({"e": expires_at, "v": value}, separators=(",", ":")).encode()
+            digest, set_index = self._digest(key)
+            if not shared_tier.set(digest, set_index, payload, ttl):
+                with self._lock:
+                    self.stats["shared_oversize"] += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._local.pop(key, None)
+        if shared_tier is not None:
+            # An already-expired entry is a miss for every worker
+            digest, set_index = self._digest(key)
+            shared_tier.set(digest, set_index, b"null", 0)
+
+    def _set_local(self, key, value, expires_at):
+        with self._lock:
+            self._local[key] = (expires_at, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+
+def cache_stats():
+    """Hit/miss counters per namespace and tier for THIS worker process."""
+    return {
+        "pid": os.getpid(),
+        "shared_tier": shared_tier.path if shared_tier is not None else None,
+        "namespaces": {name: cache.stats for name, cache in caches.items()},
+    }